@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from detect_form_type import detect_form_type
+from extract_acroform import extract_acroform
+from fill_acroform import fill_acroform_with_json
+from fill_xfa import fill_xfa_with_json
+from src.xfa_extract import extract_field_keys
+
+MODES = ("detect", "extract", "keys", "fill-acro", "fill-xfa")
+
+# Wyniki detect_form_type oznaczające błąd (jak w `detect_form_type.main`)
+DETECT_ERRORS = {"BrakPliku", "NiepoprawnyPDF", "BladOdczytu"}
+
+
+class BatchResult(NamedTuple):
+    """Wynik przetwarzania jednego pliku w partii."""
+
+    path: str
+    result: str
+    error: Optional[str]
+
+
+def _run_one(mode: str, pdf_path: str, json_path: Optional[str], out_dir: str) -> BatchResult:
+    """Przetwórz jeden PDF w procesie roboczym.
+
+    Błąd jednego pliku nie przerywa partii – trafia do `BatchResult.error`.
+    """
+    # Komunikaty funkcji jednoplikowych ("Zapisano: ...") nie trafiają do podsumowania
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _run_one_quiet(mode, pdf_path, json_path, out_dir)
+
+
+def _run_one_quiet(mode: str, pdf_path: str, json_path: Optional[str], out_dir: str) -> BatchResult:
+    pdf = Path(pdf_path)
+    out = Path(out_dir)
+    try:
+        if mode == "detect":
+            form_type = detect_form_type(pdf)
+            if form_type in DETECT_ERRORS:
+                return BatchResult(pdf_path, "", form_type)
+            return BatchResult(pdf_path, form_type, None)
+        out.mkdir(parents=True, exist_ok=True)
+        if mode == "extract":
+            xml_out = out / f"{pdf.stem}.schemat_acro.xml"
+            keys_out = out / f"{pdf.stem}.pola_acro.txt"
+            written = extract_acroform(pdf, xml_out, keys_out)
+            if written is None:
+                return BatchResult(pdf_path, "", "Brak AcroForm w PDF")
+            return BatchResult(pdf_path, str(written), None)
+        if mode == "keys":
+            keys_out = out / f"{pdf.stem}.pola.json"
+            keys = extract_field_keys(pdf)
+            keys_out.write_bytes(json.dumps(keys, ensure_ascii=False, indent=2).encode("utf-8"))
+            return BatchResult(pdf_path, str(keys_out), None)
+        if mode == "fill-acro":
+            pdf_out = out / f"{pdf.stem}.wypelniony_acro.pdf"
+            written = fill_acroform_with_json(pdf, Path(json_path), pdf_out)
+            if written is None:
+                return BatchResult(pdf_path, "", "Brak AcroForm w PDF")
+            return BatchResult(pdf_path, str(written), None)
+        if mode == "fill-xfa":
+            json_obj = json.loads(Path(json_path).read_text(encoding="utf-8"))
+            pdf_out = out / f"{pdf.stem}.wypelniony.pdf"
+            fill_xfa_with_json(pdf, json_obj, pdf_out)
+            return BatchResult(pdf_path, str(pdf_out), None)
+        return BatchResult(pdf_path, "", f"Nieznany tryb: {mode}")
+    except Exception as exc:
+        return BatchResult(pdf_path, "", str(exc))
+
+
+def run_batch(
+    mode: str,
+    pdf_paths: List[str],
+    json_path: Optional[str] = None,
+    out_dir: str = "out",
+    workers: Optional[int] = None,
+) -> List[BatchResult]:
+    """Przetwórz wiele PDF-ów równolegle (procesy, nie wątki).
+
+    pikepdf/qpdf i serializacja lxml w dużej mierze trzymają GIL, więc
+    równoległość zapewniają osobne procesy. Kolejność wyników odpowiada
+    kolejności `pdf_paths`.
+
+    Wyniki trafiają do podkatalogów `out_dir` odpowiadających położeniu plików
+    względem ich wspólnego katalogu, więc `d1/x.pdf` i `d2/x.pdf` się nie nadpisują.
+    Pliki, które mimo to dałyby tę samą nazwę wyjściową, są zgłaszane jako błąd
+    i nie są przetwarzane.
+    """
+    out_dirs = _output_dirs(pdf_paths, Path(out_dir))
+    targets: Dict[Tuple[Path, str], int] = {}
+    for pdf_path, target_dir in zip(pdf_paths, out_dirs):
+        key = (target_dir, Path(pdf_path).stem)
+        targets[key] = targets.get(key, 0) + 1
+
+    results: List[Optional[BatchResult]] = [None] * len(pdf_paths)
+    jobs: List[int] = []
+    for i, (pdf_path, target_dir) in enumerate(zip(pdf_paths, out_dirs)):
+        if mode != "detect" and targets[(target_dir, Path(pdf_path).stem)] > 1:
+            results[i] = BatchResult(
+                pdf_path, "", f"Kolizja nazw wyjściowych w {target_dir} – plik pominięty"
+            )
+        else:
+            jobs.append(i)
+
+    n = len(jobs)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as ex:
+        done = ex.map(
+            _run_one,
+            [mode] * n,
+            [pdf_paths[i] for i in jobs],
+            [json_path] * n,
+            [str(out_dirs[i]) for i in jobs],
+        )
+        for i, result in zip(jobs, done):
+            results[i] = result
+    return results  # type: ignore[return-value]
+
+
+def _output_dirs(pdf_paths: List[str], out_dir: Path) -> List[Path]:
+    """Zwróć katalog wyjściowy każdego pliku: `out_dir` + ścieżka względem wspólnego katalogu."""
+    parents = [Path(p).resolve().parent for p in pdf_paths]
+    try:
+        base = Path(os.path.commonpath(parents))
+    except ValueError:
+        # Różne dyski (Windows) – brak wspólnego katalogu, płaski układ
+        return [out_dir] * len(parents)
+    return [out_dir / parent.relative_to(base) for parent in parents]
+
+
+def main() -> int:
+    """CLI: przetwarzanie wsadowe wielu plików PDF.
+
+    Przykłady:
+    - python batch_mode.py detect "pdfy/*.pdf"
+    - python batch_mode.py extract "pdfy/*.pdf" --out out
+    - python batch_mode.py keys "pdfy/*.pdf" --out out
+    - python batch_mode.py fill-acro "pdfy/*.pdf" --json dane.json --out out
+    - python batch_mode.py fill-xfa "pdfy/*.pdf" --json dane.json --out out
+    """
+    parser = argparse.ArgumentParser(
+        description="Wsadowe przetwarzanie plików PDF (wiele procesów)",
+    )
+    parser.add_argument("mode", choices=MODES, help="Tryb przetwarzania")
+    parser.add_argument("pattern", help="Wzorzec glob plików PDF, np. 'pdfy/*.pdf'")
+    parser.add_argument("--json", dest="json_path", default="dane.json", help="Plik danych JSON (tryby fill-*)")
+    parser.add_argument("--out", dest="out_dir", default="out", help="Katalog wyjściowy (domyślnie: out)")
+    parser.add_argument("--workers", type=int, default=None, help="Liczba procesów (domyślnie: liczba CPU)")
+    args = parser.parse_args()
+
+    pdf_paths = sorted(glob.glob(args.pattern))
+    if not pdf_paths:
+        print("Brak plików PDF pasujących do wzorca.")
+        return 1
+    if args.mode.startswith("fill-") and not Path(args.json_path).exists():
+        print("BrakPlikuJSON")
+        return 1
+
+    results = run_batch(args.mode, pdf_paths, args.json_path, args.out_dir, args.workers)
+    failed = 0
+    for pdf_path, result, error in results:
+        if error:
+            failed += 1
+            print(f"{pdf_path}: Błąd: {error}")
+        else:
+            print(f"{pdf_path}: {result}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,26 +5,19 @@ import sys
 
 import pikepdf
 
+from src.pdf_session import PdfSession, open_session
 
-def _get_pdf_root(pdf: pikepdf.Pdf):
-    root = getattr(pdf, "Root", None) or getattr(pdf, "root", None)
-    if root is None:
-        try:
-            root = pdf.trailer["/Root"]
-        except Exception:
-            root = None
-    return root
 
-
-def detect_form_type(pdf_path: Path) -> str:
-    if not pdf_path.exists():
+def detect_form_type(pdf_path: str | Path | pikepdf.Pdf | PdfSession) -> str:
+    """Zwróć typ formularza; przyjmuje ścieżkę, otwarty PDF lub `PdfSession`."""
+    if isinstance(pdf_path, (str, Path)) and not Path(pdf_path).exists():
         return "BrakPliku"
     try:
-        with pikepdf.open(str(pdf_path)) as pdf:
-            root = _get_pdf_root(pdf)
+        with open_session(pdf_path) as session:
+            root = session.root
             if root is None:
                 return "NiepoprawnyPDF"
-            acro_form = root.get("/AcroForm", None)
+            acro_form = session.acro_form
             if acro_form is None:
                 return "BrakFormularza"
             xfa = acro_form.get("/XFA", None)
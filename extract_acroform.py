@@ -5,28 +5,12 @@ from typing import Any, Dict, List, Optional, Tuple
 import pikepdf
 from lxml import etree
 
+from src.pdf_session import FieldCache, PdfSession, field_info, open_session
 
 def to_str(obj: Any) -> str:
     return str(obj) if obj is not None else ""
 
 
-def is_widget(obj: pikepdf.Object) -> bool:
-    subtype = obj.get("/Subtype")
-    return to_str(subtype) == "/Widget"
-
-
-def name_of(field: pikepdf.Object) -> str:
-    return to_str(field.get("/T"))
-
-
-def get_field_flags(field: pikepdf.Object) -> int:
-    ff = field.get("/Ff")
-    try:
-        return int(ff) if ff is not None else 0
-    except Exception:
-        return 0
-
-
 def is_read_only(ff: int) -> bool:
     # ReadOnly bit: 1 << 0
     return bool(ff & (1 << 0))
@@ -42,41 +26,65 @@ def is_radio(ff: int) -> bool:
     return bool(ff & (1 << 15))
 
 
-def walk_fields(field: pikepdf.Object, parent_name: str = "") -> List[Dict[str, Any]]:
-    """Zwraca listę liści pól (mających /FT) wraz z pełną nazwą i widgetami."""
-    current_name = name_of(field)
-    if parent_name and current_name:
-        full_name = f"{parent_name}.{current_name}"
-    else:
-        full_name = current_name or parent_name
+def walk_fields(
+    field: pikepdf.Object, parent_name: str = "", cache: Optional[FieldCache] = None
+) -> List[Dict[str, Any]]:
+    """Zwraca listę liści pól (mających /FT) wraz z pełną nazwą i widgetami.
 
+    Przejście jest iteracyjne (jawny stos) i zachowuje kolejność wersji
+    rekurencyjnej: najpierw pola potomne, potem samo pole.
+    """
+    if cache is None:
+        cache = {}
     entries: List[Dict[str, Any]] = []
-    kids = field.get("/Kids")
-    widgets: List[pikepdf.Object] = []
-    child_fields: List[pikepdf.Object] = []
+    # (pole, nazwy przodków, None) przed rozwinięciem; (liść, nazwy, gotowy wpis) po nim.
+    # Nazwy przekazujemy jako krotkę i łączymy kropkami dopiero dla liścia.
+    stack: List[Tuple[pikepdf.Object, Tuple[str, ...], Optional[Dict[str, Any]]]] = [
+        (field, (parent_name,) if parent_name else (), None)
+    ]
+    while stack:
+        current, parent_parts, entry = stack.pop()
+        if entry is not None:
+            entries.append(entry)
+            continue
+
+        info = field_info(current, cache)
+        current_name = info["name"]
+        parts = parent_parts + (current_name,) if current_name else parent_parts
 
-    if kids:
-        for kid in kids:
-            if is_widget(kid):
+        widgets: List[pikepdf.Object] = []
+        child_fields: List[pikepdf.Object] = []
+        for kid in info["kids"]:
+            if field_info(kid, cache)["widget"]:
                 widgets.append(kid)
             else:
                 child_fields.append(kid)
 
-    for child in child_fields:
-        entries.extend(walk_fields(child, full_name))
-
-    ft = field.get("/FT")
-    if ft is not None:
-        entries.append({"name": full_name, "field": field, "widgets": widgets})
+        # Jeśli to liść (ma /FT), wpis trafi do wyniku po polach potomnych
+        if info["ft"] is not None:
+            leaf = {
+                "name": ".".join(parts),
+                "base": current_name,
+                "field": current,
+                "widgets": widgets,
+                "ft": info["ft"],
+                "ff": info["ff"],
+            }
+            stack.append((current, parts, leaf))
+        # Jeśli są dzieci będące polami, odłóż je na stos (odwrotnie – by zachować kolejność)
+        for child in reversed(child_fields):
+            stack.append((child, parts, None))
 
     return entries
 
 
-def flatten_all_fields(acro_form: pikepdf.Object) -> List[Dict[str, Any]]:
+def flatten_all_fields(acro_form: pikepdf.Object, cache: Optional[FieldCache] = None) -> List[Dict[str, Any]]:
+    if cache is None:
+        cache = {}
     fields = acro_form.get("/Fields") or []
     flattened: List[Dict[str, Any]] = []
     for fld in fields:
-        flattened.extend(walk_fields(fld, ""))
+        flattened.extend(walk_fields(fld, "", cache))
     return flattened
 
 
@@ -114,103 +122,126 @@ def get_appearance_names(widget: pikepdf.Object) -> Tuple[List[str], str]:
     return (on_names, off_name)
 
 
-def build_schema_xml(acro_form: pikepdf.Object) -> etree._Element:
+def _field_node(
+    field: pikepdf.Object, info: Dict[str, Any], widget_kids: List[pikepdf.Object], full_name: str
+) -> etree._Element:
+    """Buduje węzeł <field> (atrybuty, opcje, eksporty, wartości) bez pól potomnych."""
+    ft = to_str(info["ft"])
+    ff = info["ff"]
+    readonly = is_read_only(ff)
+    push = is_push_button(ff)
+    radio = is_radio(ff)
+
+    node = etree.Element("field")
+    node.set("name", full_name or "")
+    node.set("type", ft.replace("/", "") if ft else "")
+    node.set("flags", str(ff))
+    node.set("readonly", "true" if readonly else "false")
+
+    if ft == "/Ch":
+        opts = get_choice_options(field)
+        if opts:
+            opts_node = etree.SubElement(node, "options")
+            for o in opts:
+                item = etree.SubElement(opts_node, "option")
+                item.text = o
+
+    if ft == "/Btn":
+        node.set("pushbutton", "true" if push else "false")
+        node.set("radio", "true" if radio else "false")
+        # zbierz nazwy ON z widgetów
+        on_values: List[str] = []
+        for kid in widget_kids:
+            on_names, _ = get_appearance_names(kid)
+            for n in on_names:
+                if n not in on_values:
+                    on_values.append(n)
+        if on_values:
+            ons_node = etree.SubElement(node, "exports")
+            for n in on_values:
+                item = etree.SubElement(ons_node, "value")
+                item.text = n
+
+    # Bieżące wartości
+    try:
+        if ft == "/Tx":
+            v = field.get("/V")
+            if v is not None:
+                val = str(v)
+                val_node = etree.SubElement(node, "value")
+                val_node.text = val
+        elif ft == "/Ch":
+            v = field.get("/V")
+            if isinstance(v, pikepdf.Array):
+                for item in v:
+                    val_node = etree.SubElement(node, "value")
+                    val_node.text = str(item)
+            elif v is not None:
+                val_node = etree.SubElement(node, "value")
+                val_node.text = str(v)
+        elif ft == "/Btn" and not push:
+            raw_v = field.get("/V")
+            raw_s = str(raw_v) if raw_v is not None else None
+            # zbierz kandydatów ON
+            on_names: List[str] = []
+            off_name = "/Off"
+            for kid in widget_kids:
+                ons, off = get_appearance_names(kid)
+                off_name = off or off_name
+                for n in ons:
+                    if n not in on_names:
+                        on_names.append(n)
+            if radio:
+                # Radio – wartość to wybrany export (np. /M), brak → brak value
+                if raw_s and raw_s != "/Off":
+                    val_node = etree.SubElement(node, "value")
+                    val_node.text = raw_s
+            else:
+                # Checkbox – znormalizuj do true/false na podstawie /V i nazw ON
+                checked = False
+                if raw_s and on_names:
+                    checked = any(raw_s.lower() == n.lower() for n in on_names)
+                val_node = etree.SubElement(node, "value")
+                val_node.text = "true" if checked else "false"
+    except Exception:
+        # Pomijamy problemy z odczytem wartości pojedynczych pól
+        pass
+
+    return node
+
+
+def _split_kids(
+    info: Dict[str, Any], cache: FieldCache
+) -> Tuple[List[pikepdf.Object], List[pikepdf.Object]]:
+    """Dzieli /Kids pola na widgety i pola potomne."""
+    widget_kids: List[pikepdf.Object] = []
+    field_kids: List[pikepdf.Object] = []
+    for kid in info["kids"]:
+        if field_info(kid, cache)["widget"]:
+            widget_kids.append(kid)
+        else:
+            field_kids.append(kid)
+    return widget_kids, field_kids
+
+
+def build_schema_xml(acro_form: pikepdf.Object, cache: Optional[FieldCache] = None) -> etree._Element:
     """Buduje XML schematu AcroForm (hierarchia pól, typy, flagi, opcje)."""
+    if cache is None:
+        cache = {}
     root = etree.Element("acroForm")
 
     def emit_field(node_parent: etree._Element, field: pikepdf.Object, parent_name: str = ""):
-        current_name = name_of(field)
+        info = field_info(field, cache)
+        current_name = info["name"]
         full_name = f"{parent_name}.{current_name}" if parent_name and current_name else (current_name or parent_name)
-        ft = to_str(field.get("/FT"))
-        ff = get_field_flags(field)
-        readonly = is_read_only(ff)
-        push = is_push_button(ff)
-        radio = is_radio(ff)
-
-        node = etree.SubElement(node_parent, "field")
-        node.set("name", full_name or "")
-        node.set("type", ft.replace("/", "") if ft else "")
-        node.set("flags", str(ff))
-        node.set("readonly", "true" if readonly else "false")
-
-        if ft == "/Ch":
-            opts = get_choice_options(field)
-            if opts:
-                opts_node = etree.SubElement(node, "options")
-                for o in opts:
-                    item = etree.SubElement(opts_node, "option")
-                    item.text = o
-
-        if ft == "/Btn":
-            node.set("pushbutton", "true" if push else "false")
-            node.set("radio", "true" if radio else "false")
-            # zbierz nazwy ON z widgetów
-            kids = field.get("/Kids") or []
-            on_values: List[str] = []
-            for kid in kids:
-                if is_widget(kid):
-                    on_names, _ = get_appearance_names(kid)
-                    for n in on_names:
-                        if n not in on_values:
-                            on_values.append(n)
-            if on_values:
-                ons_node = etree.SubElement(node, "exports")
-                for n in on_values:
-                    item = etree.SubElement(ons_node, "value")
-                    item.text = n
-
-        # Bieżące wartości
-        try:
-            if ft == "/Tx":
-                v = field.get("/V")
-                if v is not None:
-                    val = str(v)
-                    val_node = etree.SubElement(node, "value")
-                    val_node.text = val
-            elif ft == "/Ch":
-                v = field.get("/V")
-                if isinstance(v, pikepdf.Array):
-                    for item in v:
-                        val_node = etree.SubElement(node, "value")
-                        val_node.text = str(item)
-                elif v is not None:
-                    val_node = etree.SubElement(node, "value")
-                    val_node.text = str(v)
-            elif ft == "/Btn" and not push:
-                raw_v = field.get("/V")
-                raw_s = str(raw_v) if raw_v is not None else None
-                kids = field.get("/Kids") or []
-                # zbierz kandydatów ON
-                on_names: List[str] = []
-                off_name = "/Off"
-                for kid in kids:
-                    if is_widget(kid):
-                        ons, off = get_appearance_names(kid)
-                        off_name = off or off_name
-                        for n in ons:
-                            if n not in on_names:
-                                on_names.append(n)
-                if radio:
-                    # Radio – wartość to wybrany export (np. /M), brak → brak value
-                    if raw_s and raw_s != "/Off":
-                        val_node = etree.SubElement(node, "value")
-                        val_node.text = raw_s
-                else:
-                    # Checkbox – znormalizuj do true/false na podstawie /V i nazw ON
-                    checked = False
-                    if raw_s and on_names:
-                        checked = any(raw_s.lower() == n.lower() for n in on_names)
-                    val_node = etree.SubElement(node, "value")
-                    val_node.text = "true" if checked else "false"
-        except Exception:
-            # Pomijamy problemy z odczytem wartości pojedynczych pól
-            pass
+        widget_kids, field_kids = _split_kids(info, cache)
+
+        node = _field_node(field, info, widget_kids, full_name)
+        node_parent.append(node)
 
         # dzieci będące polami
-        kids = field.get("/Kids") or []
-        for kid in kids:
-            if not is_widget(kid):
-                emit_field(node, kid, full_name)
+        for kid in field_kids:
+            emit_field(node, kid, full_name)
 
     fields = acro_form.get("/Fields") or []
     for fld in fields:
@@ -219,48 +250,88 @@ def build_schema_xml(acro_form: pikepdf.Object) -> etree._Element:
     return root
 
 
-def write_xml(file_path: Path, root: etree._Element) -> None:
-    data = etree.tostring(root, xml_declaration=True, encoding="utf-8", pretty_print=True)
+def write_schema_xml(file_path: Path, acro_form: pikepdf.Object, cache: Optional[FieldCache] = None) -> None:
+    """Zapisuje zwarty XML schematu strumieniowo (`etree.xmlfile`).
+
+    W pamięci jest tylko węzeł bieżącego pola – nie powstaje całe drzewo ani
+    jego zserializowana kopia. Wynik odpowiada `write_xml(build_schema_xml(...))`.
+    """
+    if cache is None:
+        cache = {}
+
+    with etree.xmlfile(str(file_path), encoding="utf-8") as xf:
+        xf.write_declaration()
+
+        def emit_field(field: pikepdf.Object, parent_name: str = ""):
+            info = field_info(field, cache)
+            current_name = info["name"]
+            full_name = f"{parent_name}.{current_name}" if parent_name and current_name else (current_name or parent_name)
+            widget_kids, field_kids = _split_kids(info, cache)
+
+            node = _field_node(field, info, widget_kids, full_name)
+            if not field_kids:
+                xf.write(node)
+                return
+            with xf.element(node.tag, attrib=dict(node.attrib)):
+                for child in node:
+                    xf.write(child)
+                # dzieci będące polami
+                for kid in field_kids:
+                    emit_field(kid, full_name)
+
+        with xf.element("acroForm"):
+            fields = acro_form.get("/Fields") or []
+            for fld in fields:
+                emit_field(fld, "")
+
+
+def write_xml(file_path: Path, root: etree._Element, pretty: bool = False) -> None:
+    # Domyślnie zwarty XML – formatowanie (pretty_print) tylko na życzenie
+    data = etree.tostring(root, xml_declaration=True, encoding="utf-8", pretty_print=pretty)
     file_path.write_bytes(data)
 
 
 def write_fillable_list(file_path: Path, fields: List[Dict[str, Any]]) -> None:
-    lines: List[str] = []
-    for f in fields:
-        full_name = f.get("name") or ""
-        field_obj = f["field"]
-        ft = to_str(field_obj.get("/FT"))
-        ff = get_field_flags(field_obj)
-        if not full_name:
-            continue
-        if is_read_only(ff):
-            continue
-        if ft == "/Btn" and is_push_button(ff):
-            continue
+    # /FT i /Ff są już odczytane podczas przejścia po drzewie (wpisy z walk_fields)
+    lines = [
+        f["name"]
+        for f in fields
+        if f["name"]
+        and not is_read_only(f["ff"])
+        and not (f["ft"] == "/Btn" and is_push_button(f["ff"]))
         # opcjonalnie pomijamy pola podpisu
-        if ft == "/Sig":
-            continue
-        lines.append(full_name)
+        and f["ft"] != "/Sig"
+    ]
     content = ("\n".join(lines) + "\n") if lines else ""
     file_path.write_text(content, encoding="utf-8")
 
 
-def extract_acroform(pdf_path: Path, xml_out: Path, keys_out: Path) -> None:
-    with pikepdf.open(str(pdf_path)) as pdf:
-        acro = pdf.Root.get("/AcroForm")
+def extract_acroform(
+    pdf_path: Path | pikepdf.Pdf | PdfSession, xml_out: Path, keys_out: Path, pretty: bool = False
+) -> Optional[Path]:
+    """Zapisz schemat i listę pól; zwraca ścieżkę schematu lub None, gdy brak AcroForm."""
+    with open_session(pdf_path) as session:
+        acro = session.acro_form
         if not acro:
             print("Brak AcroForm w PDF")
-            return
+            return None
+        # wspólny (w ramach sesji) cache kluczy pól dla obu przejść po drzewie
+        cache: FieldCache = session.field_cache
         # schemat
-        root = build_schema_xml(acro)
-        write_xml(xml_out, root)
+        if pretty:
+            write_xml(xml_out, build_schema_xml(acro, cache), pretty=True)
+        else:
+            write_schema_xml(xml_out, acro, cache)
         # lista pól do wypełnienia
-        flat = flatten_all_fields(acro)
+        flat = flatten_all_fields(acro, cache)
         write_fillable_list(keys_out, flat)
         print(f"Zapisano: {xml_out.name}, {keys_out.name}")
+        return xml_out
 
 
 def main(argv: List[str]) -> None:
+    pretty = "--pretty" in argv
+    argv = [a for a in argv if a != "--pretty"]
     pdf_in = Path(argv[1]) if len(argv) > 1 else Path("xfa.pdf")
     xml_out = Path(argv[2]) if len(argv) > 2 else Path("schemat_acro.xml")
     keys_out = Path(argv[3]) if len(argv) > 3 else Path("pola_acro.txt")
@@ -269,7 +340,8 @@ def main(argv: List[str]) -> None:
         print("BrakPlikuPDF")
         return
 
-    extract_acroform(pdf_in, xml_out, keys_out)
+    with PdfSession(pdf_in) as session:
+        extract_acroform(session, xml_out, keys_out, pretty)
 
 
 if __name__ == "__main__":
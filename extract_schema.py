@@ -3,6 +3,9 @@ from __future__ import annotations
 from pathlib import Path
 import sys
 
+import pikepdf
+
+from src.pdf_session import open_pdf
 from src.xfa_extract import extract_template_xml, extract_field_keys
 
 
@@ -12,8 +15,19 @@ def main() -> int:
         print("Błąd: Nie znaleziono pliku 'xfa.pdf' w katalogu głównym.")
         return 1
 
+    # Szablon i klucze pól czytamy z jednego otwarcia pliku
+    try:
+        pdf = open_pdf(pdf_path)
+    except Exception as exc:
+        print(f"Błąd: {exc}")
+        return 1
+    with pdf:
+        return _extract_schema(pdf)
+
+
+def _extract_schema(pdf: pikepdf.Pdf) -> int:
     try:
-        xml_text = extract_template_xml(pdf_path, pretty=True)
+        xml_text = extract_template_xml(pdf, pretty=True)
     except Exception as exc:
         print(f"Błąd: {exc}")
         return 1
@@ -24,7 +38,7 @@ def main() -> int:
 
     # Drugi plik: tylko klucze pól do wypełnienia
     try:
-        keys = extract_field_keys(pdf_path)
+        keys = extract_field_keys(pdf)
     except Exception as exc:
         print(f"Błąd podczas wyciągania kluczy pól: {exc}")
         keys = []
@@ -5,6 +5,14 @@ from typing import Any, Dict, List, Optional, Tuple
 
 import pikepdf
 
+from src.pdf_session import (
+    FieldCache, PdfSession, field_info, get_field_flags, open_session, save_pdf,
+)
+
+_NAME_TX = pikepdf.Name("/Tx")
+_NAME_CH = pikepdf.Name("/Ch")
+_NAME_BTN = pikepdf.Name("/Btn")
+
 
 def load_json(path: Path) -> Dict[str, Any]:
     with path.open("r", encoding="utf-8") as f:
@@ -15,54 +23,96 @@ def to_str(obj: Any) -> str:
     return str(obj) if obj is not None else ""
 
 
-def name_of(field: pikepdf.Object) -> str:
-    t = field.get("/T")
-    return to_str(t)
-
-
-def is_widget(obj: pikepdf.Object) -> bool:
-    subtype = obj.get("/Subtype")
-    return to_str(subtype) == "/Widget"
-
-
-def walk_fields(field: pikepdf.Object, parent_name: str = "") -> List[Dict[str, Any]]:
-    """Zwraca listę liści pól (mających /FT) wraz z pełną nazwą i widgetami."""
-    current_name = name_of(field)
-    if parent_name and current_name:
-        full_name = f"{parent_name}.{current_name}"
-    else:
-        full_name = current_name or parent_name
+def walk_fields(
+    field: pikepdf.Object, parent_name: str = "", cache: Optional[FieldCache] = None
+) -> List[Dict[str, Any]]:
+    """Zwraca listę liści pól (mających /FT) wraz z pełną nazwą i widgetami.
 
+    Przejście jest iteracyjne (jawny stos) i zachowuje kolejność wersji
+    rekurencyjnej: najpierw pola potomne, potem samo pole.
+    """
+    if cache is None:
+        cache = {}
     entries: List[Dict[str, Any]] = []
-    kids = field.get("/Kids")
-    widgets: List[pikepdf.Object] = []
-    child_fields: List[pikepdf.Object] = []
-
-    if kids:
-        for kid in kids:
-            if is_widget(kid):
+    # (pole, nazwy przodków, None) przed rozwinięciem; (liść, nazwy, gotowy wpis) po nim.
+    # Nazwy przekazujemy jako krotkę i łączymy kropkami dopiero dla liścia.
+    stack: List[Tuple[pikepdf.Object, Tuple[str, ...], Optional[Dict[str, Any]]]] = [
+        (field, (parent_name,) if parent_name else (), None)
+    ]
+    while stack:
+        current, parent_parts, entry = stack.pop()
+        if entry is not None:
+            entries.append(entry)
+            continue
+
+        info = field_info(current, cache)
+        current_name = info["name"]
+        parts = parent_parts + (current_name,) if current_name else parent_parts
+
+        widgets: List[pikepdf.Object] = []
+        child_fields: List[pikepdf.Object] = []
+        for kid in info["kids"]:
+            if field_info(kid, cache)["widget"]:
                 widgets.append(kid)
             else:
                 child_fields.append(kid)
 
-    # Jeśli są dzieci będące polami, wędruj rekurencyjnie
-    for child in child_fields:
-        entries.extend(walk_fields(child, full_name))
-
-    # Jeśli to liść (ma /FT), dodaj wpis
-    ft = field.get("/FT")
-    if ft is not None:
-        entries.append({"name": full_name, "field": field, "widgets": widgets})
+        # Jeśli to liść (ma /FT), wpis trafi do wyniku po polach potomnych
+        if info["ft"] is not None:
+            leaf = {
+                "name": ".".join(parts),
+                "base": current_name,
+                "field": current,
+                "widgets": widgets,
+                "ft": info["ft"],
+                "ff": info["ff"],
+            }
+            stack.append((current, parts, leaf))
+        # Jeśli są dzieci będące polami, odłóż je na stos (odwrotnie – by zachować kolejność)
+        for child in reversed(child_fields):
+            stack.append((child, parts, None))
 
     return entries
 
 
-def flatten_all_fields(acro_form: pikepdf.Object) -> List[Dict[str, Any]]:
-    fields = acro_form.get("/Fields") or []
-    flattened: List[Dict[str, Any]] = []
-    for fld in fields:
-        flattened.extend(walk_fields(fld, ""))
-    return flattened
+def index_all_fields(
+    acro_form: pikepdf.Object, cache: Optional[FieldCache] = None
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+    """Jednym przejściem buduje mapy: pełna nazwa -> pole oraz skrótowe '/T' -> pola."""
+    if cache is None:
+        cache = {}
+    by_name: Dict[str, Dict[str, Any]] = {}
+    short_names_map: Dict[str, List[Dict[str, Any]]] = {}
+    for fld in acro_form.get("/Fields") or []:
+        for f in walk_fields(fld, "", cache):
+            if f["name"]:
+                by_name[f["name"]] = f
+            # dopasuj także po samym '/T', bez rodzica (skrótowe nazwy)
+            if f["base"]:
+                short_names_map.setdefault(f["base"], []).append(f)
+    return by_name, short_names_map
+
+
+def build_resolvers(
+    by_name: Dict[str, Dict[str, Any]], short_names_map: Dict[str, List[Dict[str, Any]]]
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """Buduje słowniki dopasowania kluczy JSON do pól: dokładny i małymi literami.
+
+    W każdym z nich pełne nazwy mają pierwszeństwo przed skrótowymi '/T'
+    (uwzględniane tylko unikalne), a przy kolizjach wygrywa pierwsze wystąpienie.
+    Słownik dokładny sprawdzamy przed słownikiem małych liter.
+    """
+    exact: Dict[str, Dict[str, Any]] = dict(by_name)
+    lowered: Dict[str, Dict[str, Any]] = {}
+    for n, f in by_name.items():
+        lowered.setdefault(n.lower(), f)
+    for base, flist in short_names_map.items():
+        if len(flist) == 1:
+            exact.setdefault(base, flist[0])
+    for base, flist in short_names_map.items():
+        if len(flist) == 1:
+            lowered.setdefault(base.lower(), flist[0])
+    return exact, lowered
 
 
 def get_appearance_names(widget: pikepdf.Object) -> Tuple[List[str], str]:
@@ -81,14 +131,6 @@ def get_appearance_names(widget: pikepdf.Object) -> Tuple[List[str], str]:
     return (on_names, off_name)
 
 
-def get_field_flags(field: pikepdf.Object) -> int:
-    ff = field.get("/Ff")
-    try:
-        return int(ff) if ff is not None else 0
-    except Exception:
-        return 0
-
-
 def is_push_button(ff: int) -> bool:
     # PushButton bit (per PDF spec): 1 << 16
     return bool(ff & (1 << 16))
@@ -137,20 +179,32 @@ def set_choice(field: pikepdf.Object, value: Any) -> None:
         field["/V"] = str(value) if value is not None else ""
 
 
+# Ustawianie wartości wg /FT dla pól o prostej wartości (/Btn obsługiwane osobno)
+_VALUE_SETTERS = {_NAME_TX: set_text, _NAME_CH: set_choice}
+
+
 def set_checkbox_or_radio(field: pikepdf.Object, widgets: List[pikepdf.Object], value: Any) -> None:
     ff = get_field_flags(field)
     if is_push_button(ff):
         return  # nic do ustawiania
 
+    # nazwy wyglądów każdego widgetu odczytujemy raz – używane w obu przebiegach
+    widget_info = [(w, *get_appearance_names(w)) for w in widgets]
+
     # zbierz kandydatów z widgetów
     all_on_names: List[str] = []
     off_name = "/Off"
-    for w in widgets:
-        on_names, off = get_appearance_names(w)
+    if len(widget_info) == 1:
+        # typowy checkbox – jeden widget, nie ma czego scalać
+        _, on_names, off = widget_info[0]
+        all_on_names = list(on_names)
         off_name = off or off_name
-        for n in on_names:
-            if n not in all_on_names:
-                all_on_names.append(n)
+    else:
+        for _, on_names, off in widget_info:
+            off_name = off or off_name
+            for n in on_names:
+                if n not in all_on_names:
+                    all_on_names.append(n)
 
     selected_on = normalize_on_value(value, all_on_names) if all_on_names else None
 
@@ -158,8 +212,7 @@ def set_checkbox_or_radio(field: pikepdf.Object, widgets: List[pikepdf.Object],
         # radio: ustaw wybraną wartość, inne widgety OFF
         if selected_on:
             field["/V"] = pikepdf.Name(selected_on)
-            for w in widgets:
-                on_names, off = get_appearance_names(w)
+            for w, on_names, off in widget_info:
                 if selected_on in on_names:
                     w["/AS"] = pikepdf.Name(selected_on)
                 else:
@@ -173,8 +226,7 @@ def set_checkbox_or_radio(field: pikepdf.Object, widgets: List[pikepdf.Object],
         # checkbox: True -> ON, False/None -> OFF
         if selected_on:
             field["/V"] = pikepdf.Name(selected_on)
-            for w in widgets:
-                on_names, off = get_appearance_names(w)
+            for w, on_names, _ in widget_info:
                 # checkbox zwykle ma 1 on_name; użyj pierwszego
                 on = on_names[0] if on_names else "/Yes"
                 w["/AS"] = pikepdf.Name(on)
@@ -184,81 +236,82 @@ def set_checkbox_or_radio(field: pikepdf.Object, widgets: List[pikepdf.Object],
                 w["/AS"] = pikepdf.Name(off_name)
 
 
-def fill_acroform_with_json(pdf_in: Path, json_in: Path, pdf_out: Path) -> None:
+def generate_appearances(pdf: pikepdf.Pdf) -> bool:
+    """Wygeneruj strumienie wyglądu (/AP) pól na podstawie /V i /DA.
+
+    Po powodzeniu qpdf usuwa /NeedAppearances, więc viewer (i kolejny etap
+    przetwarzania) nie musi odbudowywać wyglądu przy każdym otwarciu.
+    Zwraca False, gdy generowanie się nie powiodło – wtedy zostaje /NeedAppearances.
+    """
+    try:
+        pdf.generate_appearance_streams()
+        return True
+    except pikepdf.PdfError:
+        return False
+
+
+def fill_acroform_with_json(
+    pdf_in: Path | pikepdf.Pdf | PdfSession,
+    json_in: Path,
+    pdf_out: Path,
+    appearances: bool = False,
+) -> Optional[Path]:
+    """Wypełnij pola AcroForm danymi z JSON.
+
+    Zwraca ścieżkę faktycznie zapisanego pliku (także `*_alt`, gdy `pdf_out`
+    jest zablokowany) lub None, gdy PDF nie ma AcroForm.
+    """
     data = load_json(json_in)
-    with pikepdf.open(str(pdf_in)) as pdf:
-        acro = pdf.Root.get("/AcroForm")
+    with open_session(pdf_in) as session:
+        pdf = session.pdf
+        acro = session.acro_form
         if not acro:
             print("Brak AcroForm w PDF – pomiń lub użyj fill_xfa.py")
-            return
+            return None
 
         # Ustaw NeedAppearances, aby viewer wygenerował wygląd wartości
         acro["/NeedAppearances"] = True
 
-        fields = flatten_all_fields(acro)
-        by_name: Dict[str, Dict[str, Any]] = {f["name"]: f for f in fields if f["name"]}
-
-        # dopasuj także po samym '/T', bez rodzica (skrótowe nazwy)
-        short_names_map: Dict[str, List[Dict[str, Any]]] = {}
-        for f in fields:
-            base = name_of(f["field"]) or ""
-            if base:
-                short_names_map.setdefault(base, []).append(f)
+        # mapy pól są zapamiętywane w sesji – struktura drzewa się nie zmienia
+        if session.field_index is None:
+            session.field_index = index_all_fields(acro, session.field_cache)
+        by_name, short_names_map = session.field_index
 
         def apply_value_to_field(fentry: Dict[str, Any], value: Any) -> None:
             field_obj = fentry["field"]
-            widgets = fentry["widgets"]
-            ft = to_str(field_obj.get("/FT"))
-            if ft == "/Tx":
-                set_text(field_obj, value)
-            elif ft == "/Ch":
-                set_choice(field_obj, value)
-            elif ft == "/Btn":
-                set_checkbox_or_radio(field_obj, widgets, value)
-            else:
-                # inne typy np. /Sig – ignoruj
-                pass
-
+            ft = fentry["ft"]
+            if ft == _NAME_BTN:
+                set_checkbox_or_radio(field_obj, fentry["widgets"], value)
+                return
+            # inne typy np. /Sig – ignoruj
+            setter = _VALUE_SETTERS.get(ft) if isinstance(ft, pikepdf.Name) else None
+            if setter is not None:
+                setter(field_obj, value)
+
+        exact, lowered = build_resolvers(by_name, short_names_map)
         for key, value in data.items():
-            # 1) pełna nazwa pola
-            fentry = by_name.get(key)
+            # pełna nazwa lub skrótowe /T, a w drugiej kolejności to samo bez rozróżniania wielkości liter
+            fentry = exact.get(key) or lowered.get(key.lower())
             if fentry:
                 apply_value_to_field(fentry, value)
-                continue
-            # 2) skrótowe /T (jeśli unikalne)
-            candidates = short_names_map.get(key, [])
-            if len(candidates) == 1:
-                apply_value_to_field(candidates[0], value)
-                continue
-            # 3) próba dopasowania bez rozróżniania wielkości liter
-            lc_key = key.lower()
-            # pełne
-            match_full = next((f for n, f in by_name.items() if n.lower() == lc_key), None)
-            if match_full:
-                apply_value_to_field(match_full, value)
-                continue
-            # skrótowe
-            match_short = None
-            for base, flist in short_names_map.items():
-                if base.lower() == lc_key and len(flist) == 1:
-                    match_short = flist[0]
-                    break
-            if match_short:
-                apply_value_to_field(match_short, value)
-            else:
-                # brak dopasowania – pomiń
-                pass
+
+        if appearances and not generate_appearances(pdf):
+            print("Uwaga: nie udało się wygenerować wyglądu pól – pozostawiono /NeedAppearances")
 
         try:
-            pdf.save(str(pdf_out))
+            save_pdf(pdf, pdf_out)
             print(f"Zapisano: {pdf_out.name}")
+            return pdf_out
         except PermissionError:
             alt = pdf_out.with_name(pdf_out.stem + "_alt" + pdf_out.suffix)
-            pdf.save(str(alt))
+            save_pdf(pdf, alt)
             print(f"Plik zablokowany, zapisano alternatywnie: {alt.name}")
+            return alt
 
 
 def main(argv: List[str]) -> None:
+    appearances = "--appearances" in argv
+    argv = [a for a in argv if a != "--appearances"]
     pdf_in = Path(argv[1]) if len(argv) > 1 else Path("xfa.pdf")
     json_in = Path(argv[2]) if len(argv) > 2 else Path("dane.json")
     pdf_out = Path(argv[3]) if len(argv) > 3 else Path("wypelniony_acro.pdf")
@@ -270,7 +323,8 @@ def main(argv: List[str]) -> None:
         print("BrakPlikuJSON")
         return
 
-    fill_acroform_with_json(pdf_in, json_in, pdf_out)
+    with PdfSession(pdf_in) as session:
+        fill_acroform_with_json(session, json_in, pdf_out, appearances)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,32 @@
 from __future__ import annotations
 
+import functools
 import json
+import re
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 import pikepdf
 from lxml import etree
 
-from src.xfa_extract import read_xfa_packets, get_bindings_from_template, get_som_paths_from_template
+from src.pdf_session import open_pdf, save_pdf
+from src.xfa_extract import read_xfa_packets, TemplateIndex
+
+# Rozdzielanie ścieżek `bind/@ref` i usuwanie indeksów [n]
+_SPLIT_RE = re.compile(r"[./]")
+_INDEX_RE = re.compile(r"\[.*?\]")
+
+_NAME_DATASETS = pikepdf.Name('/datasets')
+
+
+# Jeden parser dla wszystkich wywołań _parse_xml.
+# collect_ids=False – nie budujemy słownika xml:id (nieużywany, a kosztowny);
+# huge_tree=True – duże pakiety datasets/XDP nie są obcinane przez limity libxml2
+_PARSER = etree.XMLParser(remove_blank_text=True, recover=True, huge_tree=True, collect_ids=False)
 
 
 def _parse_xml(xml_bytes: bytes) -> etree._Element:
-    parser = etree.XMLParser(remove_blank_text=True, recover=True)
-    return etree.fromstring(xml_bytes, parser)
+    return etree.fromstring(xml_bytes, _PARSER)
 
 
 def _ensure_datasets(root: etree._Element) -> etree._Element:
@@ -35,25 +49,49 @@ def _get_or_create_data_root(datasets: etree._Element) -> etree._Element:
     return data
 
 
-def _set_value_by_ref(data_root: etree._Element, ref: str, value: Any) -> None:
-    # Proste odwzorowanie: ścieżka z `bind/@ref` rozdzielona po kropkach lub ukośnikach
-    import re
+@functools.lru_cache(maxsize=4096)
+def _parse_ref(ref: str) -> Tuple[str, ...]:
+    """Rozbij ścieżkę `bind/@ref` na nazwy kolejnych węzłów (bez indeksów [n]).
 
-    path_parts = [p for p in re.split(r"[./]", ref.strip()) if p]
+    Wynik jest zapamiętywany – ta sama ścieżka jest rozbijana przy rozwiązywaniu
+    dopasowań i ponownie przy ustawianiu wartości.
+    """
+    return tuple(_INDEX_RE.sub("", p) for p in _SPLIT_RE.split(ref.strip()) if p)
+
+
+def _set_value_by_ref(
+    data_root: etree._Element,
+    ref: str,
+    value: Any,
+    path_cache: Optional[Dict[Tuple[str, ...], etree._Element]] = None,
+) -> None:
+    """Ustaw wartość węzła wskazanego ścieżką `ref`, tworząc brakujące węzły.
+
+    `path_cache` (współdzielony między wywołaniami dla tego samego `data_root`)
+    zapamiętuje węzły dla już odwiedzonych prefiksów ścieżek, więc klucze
+    o wspólnym prefiksie nie przeszukują ponownie tych samych poziomów drzewa.
+    """
+    # Proste odwzorowanie: ścieżka z `bind/@ref` rozdzielona po kropkach lub ukośnikach
+    path_parts = _parse_ref(ref)
     if not path_parts:
         return
+    if path_cache is None:
+        path_cache = {}
 
     # Iteracyjnie twórz węzły
     current = data_root
-    for idx, part in enumerate(path_parts):
-        # Usuń indeksy [n]
-        name = re.sub(r"\[.*?\]", "", part)
-        child = current.find(f'./*[@name="{name}"]')  # mało wiarygodne dla XFA, fallback poniżej
+    prefix: Tuple[str, ...] = ()
+    for name in path_parts:
+        prefix += (name,)
+        child = path_cache.get(prefix)
         if child is None:
-            # XFA datasets zwykle używa elementów bez atrybutu name; tworzymy tag z nazwą
-            child = current.find(f'./{name}')
-        if child is None:
-            child = etree.SubElement(current, name)
+            child = current.find(f'./*[@name="{name}"]')  # mało wiarygodne dla XFA, fallback poniżej
+            if child is None:
+                # XFA datasets zwykle używa elementów bez atrybutu name; tworzymy tag z nazwą
+                child = current.find(f'./{name}')
+            if child is None:
+                child = etree.SubElement(current, name)
+            path_cache[prefix] = child
         current = child
 
     # Ustaw wartość końcową
@@ -66,17 +104,27 @@ def _set_value_by_ref(data_root: etree._Element, ref: str, value: Any) -> None:
 
 
 def fill_xfa_with_json(pdf_in: Path, json_obj: Dict[str, Any], pdf_out: Path) -> None:
-    packets = read_xfa_packets(pdf_in)
+    # Jedno otwarcie pliku: odczyt pakietów i zapis datasets na tym samym dokumencie
+    with open_pdf(pdf_in) as pdf:
+        _fill_xfa_in_pdf(pdf, json_obj)
+        save_pdf(pdf, pdf_out)
+
+
+def _fill_xfa_in_pdf(pdf: pikepdf.Pdf, json_obj: Dict[str, Any]) -> None:
+    packets = read_xfa_packets(pdf)
     if 'template' not in packets and 'xfa' not in packets:
         raise ValueError('PDF nie zawiera XFA – wymagany do wypełniania.')
 
-    # Zbuduj mapę name->ref z template lub z pełnego XDP
+    # Zbuduj mapy name->ref i name->SOM z template lub z pełnego XDP (jedno przejście).
+    # Pełny XDP parsujemy raz – to samo drzewo posłuży niżej do podmiany datasets.
+    xdp_root = None
     if 'template' in packets:
-        bindings = get_bindings_from_template(packets['template'])
-        som_paths = get_som_paths_from_template(packets['template'])
+        index = TemplateIndex.from_bytes(packets['template'])
     else:
-        bindings = get_bindings_from_template(packets['xfa'])
-        som_paths = get_som_paths_from_template(packets['xfa'])
+        xdp_root = _parse_xml(packets['xfa'])
+        index = TemplateIndex.from_bytes(xdp_root)
+    bindings = index.bindings
+    som_paths = index.som_paths
 
     # Przygotuj datasets do modyfikacji
     existing_datasets_bytes = packets.get('datasets')
@@ -86,63 +134,79 @@ def fill_xfa_with_json(pdf_in: Path, json_obj: Dict[str, Any], pdf_out: Path) ->
         # Utwórz pusty datasets
         datasets_root = etree.Element('datasets')
     data_root = _get_or_create_data_root(datasets_root)
+    path_cache: Dict[Tuple[str, ...], etree._Element] = {}
 
     # Mapowanie kluczy JSON do bind/@ref: próbujemy dopasować po:
     # 1) bezpośrednim kluczu == ref
     # 2) kluczu odpowiadającemu nazwie pola
     # 3) w przeciwnym razie traktuj klucz jako ścieżkę
+    # Najpierw rozwiązujemy wszystkie dopasowania do tabeli ścieżka -> (ref, wartość),
+    # a dopiero potem modyfikujemy XML – raz na ścieżkę. Kolejność wstawiania
+    # odpowiada pierwszemu zapisowi, a wartość ostatniemu (jak przy kolejnych przebiegach).
+    resolved: Dict[Tuple[str, ...], Tuple[str, Any]] = {}
+
+    def resolve(ref: str, value: Any) -> None:
+        parts = _parse_ref(ref)
+        if parts:
+            resolved[parts] = (ref, value)
+
     for field_name, ref in bindings.items():
         if ref in json_obj:
-            _set_value_by_ref(data_root, ref, json_obj[ref])
+            resolve(ref, json_obj[ref])
     for field_name, ref in bindings.items():
         if field_name in json_obj:
-            _set_value_by_ref(data_root, ref, json_obj[field_name])
+            resolve(ref, json_obj[field_name])
     # 2b) Jeśli mamy ścieżkę SOM dla nazwy pola, użyj jej (często bez bind)
     for field_name, som in som_paths.items():
         if field_name in json_obj:
-            _set_value_by_ref(data_root, som, json_obj[field_name])
+            resolve(som, json_obj[field_name])
+    bound_refs = set(bindings.values())
     for k, v in json_obj.items():
-        if k not in bindings and k not in bindings.values():
-            _set_value_by_ref(data_root, k, v)
+        if k not in bindings and k not in bound_refs:
+            resolve(k, v)
+
+    for ref, value in resolved.values():
+        _set_value_by_ref(data_root, ref, value, path_cache)
 
     datasets_bytes = etree.tostring(datasets_root, xml_declaration=False, encoding='utf-8')
 
-    # Zapisz do PDF – zaktualizuj tylko strumień 'datasets' (dla XFA array)
-    with pikepdf.open(str(pdf_in)) as pdf:
-        root = getattr(pdf, 'root', None) or getattr(pdf, 'Root', None) or pdf.trailer['/Root']
-        acro = root['/AcroForm']
-        xfa = acro['/XFA']
-
-        if isinstance(xfa, pikepdf.Array):
-            replaced = False
-            for i in range(0, len(xfa) - 1, 2):
-                key = str(xfa[i]).lstrip('/')
-                if key == 'datasets':
-                    stream = xfa[i + 1]
-                    try:
-                        stream.set_bytes(datasets_bytes)
-                    except Exception:
-                        xfa[i + 1] = pikepdf.Stream(pdf, datasets_bytes)
-                    replaced = True
-                    break
-            if not replaced:
-                xfa.append(pikepdf.Name('/datasets'))
-                xfa.append(pikepdf.Stream(pdf, datasets_bytes))
-        else:
-            # pojedynczy strumień XFA – musimy zaktualizować pełny XDP
+    # Zaktualizuj tylko strumień 'datasets' (dla XFA array)
+    root = getattr(pdf, 'root', None) or getattr(pdf, 'Root', None) or pdf.trailer['/Root']
+    acro = root['/AcroForm']
+    xfa = acro['/XFA']
+
+    if isinstance(xfa, pikepdf.Array):
+        replaced = False
+        for i in range(0, len(xfa) - 1, 2):
+            key = xfa[i]
+            # Nazwy pakietów to zwykle Name – porównanie bez konwersji do str
+            if key == _NAME_DATASETS or (
+                not isinstance(key, pikepdf.Name) and str(key).lstrip('/') == 'datasets'
+            ):
+                stream = xfa[i + 1]
+                try:
+                    stream.set_bytes(datasets_bytes)
+                except Exception:
+                    xfa[i + 1] = pikepdf.Stream(pdf, datasets_bytes)
+                replaced = True
+                break
+        if not replaced:
+            xfa.append(_NAME_DATASETS)
+            xfa.append(pikepdf.Stream(pdf, datasets_bytes))
+    else:
+        # pojedynczy strumień XFA – musimy zaktualizować pełny XDP
+        if xdp_root is None:
             xdp_root = _parse_xml(packets['xfa'])
-            xdp_datasets = _ensure_datasets(xdp_root)
-            # wymień datasets na nasz
-            parent = xdp_datasets.getparent()
-            if parent is not None:
-                parent.replace(xdp_datasets, datasets_root)
-            updated_xdp = etree.tostring(xdp_root, xml_declaration=True, encoding='utf-8')
-            try:
-                xfa.set_bytes(updated_xdp)  # type: ignore[attr-defined]
-            except Exception:
-                acro['/XFA'] = pikepdf.Stream(pdf, updated_xdp)
-
-        pdf.save(str(pdf_out))
+        xdp_datasets = _ensure_datasets(xdp_root)
+        # wymień datasets na nasz
+        parent = xdp_datasets.getparent()
+        if parent is not None:
+            parent.replace(xdp_datasets, datasets_root)
+        updated_xdp = etree.tostring(xdp_root, xml_declaration=True, encoding='utf-8')
+        try:
+            xfa.set_bytes(updated_xdp)  # type: ignore[attr-defined]
+        except Exception:
+            acro['/XFA'] = pikepdf.Stream(pdf, updated_xdp)
 
 
 def main() -> int:
@@ -1,5 +1,5 @@
 """Pakiet narzędzi do pracy z PDF XFA.
 
 Ten pakiet zawiera funkcje do ekstrakcji pakietów XFA (np. template, datasets)
-z plików PDF oraz pomocnicze narzędzia CLI.
+z plików PDF, wspólną sesję PDF (`pdf_session`) oraz pomocnicze narzędzia CLI.
 """
\ No newline at end of file
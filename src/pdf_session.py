@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import io
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pikepdf
+
+_NAME_WIDGET = pikepdf.Name("/Widget")
+
+# Odczytane klucze pól AcroForm: objgen -> słownik (zob. `field_info`)
+FieldCache = Dict[Tuple[int, int], Dict[str, Any]]
+
+# Pliki do tego rozmiaru są wczytywane do pamięci przed parsowaniem
+IN_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+
+
+def open_pdf(pdf_path: str | Path, size: Optional[int] = None) -> pikepdf.Pdf:
+    """Otwórz PDF; mniejsze pliki parsuj z bufora w pamięci.
+
+    Parsowanie xref przez qpdf wykonuje wiele drobnych odczytów z przeskokami;
+    na buforze `BytesIO` nie kosztują one wywołań systemowych. Duże pliki
+    (powyżej `IN_MEMORY_MAX_BYTES`) są otwierane bezpośrednio ze ścieżki.
+    `size` – znany już rozmiar pliku (np. z wcześniejszego `stat`), bez ponownego `stat`.
+    """
+    pdf_path = Path(pdf_path)
+    if size is None:
+        size = pdf_path.stat().st_size
+    if size <= IN_MEMORY_MAX_BYTES:
+        try:
+            return pikepdf.open(io.BytesIO(pdf_path.read_bytes()))
+        except pikepdf.PdfError as exc:
+            # qpdf opisuje bufor jako "stream <_io.BytesIO ...>" – podaj nazwę pliku
+            msg = str(exc)
+            if msg.startswith("stream <"):
+                msg = msg.partition(": ")[2] or msg
+            raise type(exc)(f"{pdf_path}: {msg}") from exc
+    return pikepdf.open(str(pdf_path))
+
+
+def save_pdf(pdf: pikepdf.Pdf, pdf_out: str | Path) -> None:
+    """Zapisz PDF w zwartej postaci (strumienie obiektów, kompresja strumieni).
+
+    Małe obiekty trafiają do skompresowanych ObjStm, dzięki czemu plik jest
+    mniejszy, a jego ponowne otwarcie (np. w kolejnym etapie) szybsze.
+    """
+    pdf.save(
+        str(pdf_out),
+        object_stream_mode=pikepdf.ObjectStreamMode.generate,
+        compress_streams=True,
+        stream_decode_level=pikepdf.StreamDecodeLevel.generalized,
+    )
+
+
+def get_field_flags(field: pikepdf.Object) -> int:
+    """Zwróć flagi pola (/Ff) jako int; brak lub niepoprawna wartość to 0."""
+    ff = field.get("/Ff", 0)
+    # pikepdf zwraca liczby całkowite jako int – szybka ścieżka bez try/except
+    if type(ff) is int:
+        return ff
+    try:
+        return int(ff) if ff is not None else 0
+    except Exception:
+        return 0
+
+
+def field_info(field: pikepdf.Object, cache: Optional[FieldCache] = None) -> Dict[str, Any]:
+    """Zwraca jednorazowo odczytane klucze pola (/T, /FT, /Ff, /Kids) i to, czy jest widgetem.
+
+    Wspólna definicja dla ekstrakcji i wypełniania – oba etapy mogą dzielić
+    `PdfSession.field_cache`, więc kształt wpisu musi być jeden:
+
+    - `name` – /T jako str ('' gdy brak),
+    - `ft` – surowe /FT (`pikepdf.Name`) lub None dla kontenerów,
+    - `ff` – /Ff jako int, `kids` – lista /Kids, `widget` – czy to widget.
+
+    Dla obiektów pośrednich wynik jest zapamiętywany w `cache` po `objgen`.
+    """
+    objgen = field.objgen
+    cacheable = cache is not None and objgen != (0, 0)
+    if cacheable:
+        info = cache.get(objgen)
+        if info is not None:
+            return info
+    t = field.get("/T")
+    kids = field.get("/Kids")
+    info = {
+        "name": str(t) if t is not None else "",
+        "ft": field.get("/FT"),
+        "ff": get_field_flags(field),
+        "kids": list(kids) if kids else [],
+        "widget": field.get("/Subtype") == _NAME_WIDGET,
+    }
+    if cacheable:
+        cache[objgen] = info
+    return info
+
+
+class PdfSession:
+    """Jedno otwarcie pliku PDF współdzielone przez kolejne etapy przetwarzania.
+
+    Typowy przepływ (wykrycie typu → ekstrakcja → wypełnienie) bez sesji
+    otwiera i parsuje ten sam plik (xref, trailer) kilka razy. Sesja trzyma
+    jeden obiekt `pikepdf.Pdf` oraz zapamiętane dane pochodne:
+
+    - `root`, `acro_form` – katalog główny i słownik /AcroForm,
+    - `field_cache` – odczytane klucze pól (objgen -> wpis `field_info`),
+    - `field_index` – mapy (pełna nazwa -> pole, skrótowe /T -> pola).
+    """
+
+    def __init__(self, pdf: str | Path | pikepdf.Pdf) -> None:
+        if isinstance(pdf, pikepdf.Pdf):
+            self.path: Optional[Path] = None
+            self.pdf = pdf
+            self._owned = False
+        else:
+            self.path = Path(pdf)
+            self.pdf = open_pdf(self.path)
+            self._owned = True
+        self._root: Any = None
+        self.field_cache: FieldCache = {}
+        self.field_index: Optional[
+            Tuple[Dict[str, Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]
+        ] = None
+
+    @property
+    def root(self):
+        """Zwróć /Root dokumentu lub None, jeśli go brak."""
+        if self._root is None:
+            pdf = self.pdf
+            root = getattr(pdf, "Root", None) or getattr(pdf, "root", None)
+            if root is None:
+                try:
+                    root = pdf.trailer["/Root"]
+                except Exception:
+                    root = None
+            self._root = root
+        return self._root
+
+    @property
+    def acro_form(self):
+        """Zwróć słownik /AcroForm lub None."""
+        root = self.root
+        return root.get("/AcroForm", None) if root is not None else None
+
+    def close(self) -> None:
+        """Zamknij PDF, jeśli został otwarty przez sesję."""
+        if self._owned:
+            self.pdf.close()
+
+    def __enter__(self) -> "PdfSession":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+@contextmanager
+def open_session(source: str | Path | pikepdf.Pdf | PdfSession) -> Iterator[PdfSession]:
+    """Zwróć sesję dla ścieżki, otwartego `pikepdf.Pdf` lub istniejącej sesji.
+
+    Zamykany jest tylko PDF otwarty tutaj; przekazane obiekty pozostają otwarte.
+    """
+    if isinstance(source, PdfSession):
+        yield source
+        return
+    with PdfSession(source) as session:
+        yield session
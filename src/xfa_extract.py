@@ -1,11 +1,70 @@
 from __future__ import annotations
 
+import functools
+import io
+import os
+import re
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from types import MappingProxyType
+from typing import (
+    Any, Callable, Dict, FrozenSet, Iterator, Mapping, Optional, Tuple, Union,
+)
 
 import pikepdf
 from lxml import etree
 
+from .pdf_session import open_pdf
+
+
+# Indeksy w ścieżkach SOM/bind, np. [0]
+_IDX_RE = re.compile(r"\[.*?\]")
+
+# Surowe bajty XML albo już sparsowany korzeń drzewa
+XmlSource = Union[bytes, etree._Element]
+
+# Powyżej tego rozmiaru nazwy pól zbieramy strumieniowo (bez budowy całego drzewa)
+STREAM_MIN_BYTES = 1024 * 1024
+
+
+# Parsery współdzielone przez cały moduł (bez tworzenia obiektu przy każdym wywołaniu)
+_STRICT_PARSER = etree.XMLParser(remove_blank_text=True)
+_RECOVER_PARSER = etree.XMLParser(remove_blank_text=True, recover=True)
+
+
+def _parse_xml(xml_bytes: bytes) -> etree._Element:
+    """Sparsuj XML; najpierw parser ścisły, tryb odzyskiwania tylko dla niepoprawnego XML.
+
+    Wyniki nie są zapamiętywane – drzewo lxml bywa wielokrotnie większe od
+    pakietu. Funkcje, które potrzebują kilku informacji z tego samego pakietu,
+    parsują go raz i przekazują dalej korzeń (zob. `XmlSource`, `TemplateIndex`).
+    """
+    try:
+        return etree.fromstring(xml_bytes, _STRICT_PARSER)
+    except etree.XMLSyntaxError:
+        return etree.fromstring(xml_bytes, _RECOVER_PARSER)
+
+
+def _as_root(xml: XmlSource) -> etree._Element:
+    """Zwróć korzeń drzewa dla bajtów XML lub przekazanego już elementu."""
+    if isinstance(xml, etree._Element):
+        return xml
+    return _parse_xml(xml)
+
+
+def _local_name(el: etree._Element) -> str:
+    """Zwróć nazwę lokalną elementu (bez przestrzeni nazw); '' dla komentarzy/PI."""
+    tag = el.tag
+    return tag.rpartition('}')[2] if isinstance(tag, str) else ''
+
+
+# Filtr tagów dla lxml: dowolna przestrzeń nazw. Filtrowanie odbywa się w C,
+# a `{*}` nie jest wolniejsze od konkretnej przestrzeni – i nie gubi elementów
+# z innych przestrzeni nazw w dokumentach mieszanych.
+_TEMPLATE_TAGS = ('{*}subform', '{*}field', '{*}exclGroup', '{*}bind')
+
 
 def _get_pdf_root(pdf: pikepdf.Pdf):
     """Zwróć katalog główny PDF (/Root) w sposób kompatybilny między wersjami pikepdf."""
@@ -26,17 +85,31 @@ def _obj_to_bytes(obj) -> bytes:
 
     Obsługuje zarówno strumienie (Stream) jak i obiekty tekstowe (String/Name -> str).
     """
-    if hasattr(obj, "read_bytes"):
-        try:
-            return obj.read_bytes()  # type: ignore[attr-defined]
-        except Exception:
-            pass
-    # Fallback dla String/Name – konwersja do tekstu
+    if isinstance(obj, pikepdf.Stream):
+        return obj.read_bytes()
+    # String/Name – konwersja do tekstu
     s = str(obj)
     return s.encode("utf-8", errors="ignore")
 
 
-def read_xfa_packets(pdf_path: str | Path) -> Dict[str, bytes]:
+def _stat_pdf(pdf_path: Path) -> os.stat_result:
+    """Zwróć `stat` pliku PDF; brak pliku zgłoś czytelnym FileNotFoundError."""
+    try:
+        return pdf_path.stat()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Nie znaleziono pliku: {pdf_path}") from None
+
+
+def _resolve_pdf(pdf_path: str | Path) -> Tuple[Path, os.stat_result]:
+    """Zamień ścieżkę na `Path` i sprawdź (jednym `stat`), że plik istnieje.
+
+    Zwraca też wynik `stat`, aby kolejne kroki (np. `open_pdf`) nie powtarzały go.
+    """
+    pdf_path = Path(pdf_path)
+    return pdf_path, _stat_pdf(pdf_path)
+
+
+def read_xfa_packets(pdf_path: str | Path | pikepdf.Pdf) -> Dict[str, bytes]:
     """Odczytaj pakiety XFA z pliku PDF.
 
     Zwraca słownik: nazwa_pakietu -> bytes (surowe XML/XDP).
@@ -45,43 +118,94 @@ def read_xfa_packets(pdf_path: str | Path) -> Dict[str, bytes]:
     - /AcroForm posiada /XFA jako tablicę naprzemiennie: nazwa, strumień
     - /AcroForm posiada /XFA jako pojedynczy strumień (bez nazw pakietów)
 
-    :param pdf_path: Ścieżka do pliku PDF (XFA)
+    :param pdf_path: Ścieżka do pliku PDF (XFA) lub już otwarty `pikepdf.Pdf`
     :raises ValueError: gdy PDF nie zawiera XFA
     """
+    if isinstance(pdf_path, pikepdf.Pdf):
+        return _read_xfa_packets_from_pdf(pdf_path)
+
     pdf_path = Path(pdf_path)
-    if not pdf_path.exists():
-        raise FileNotFoundError(f"Nie znaleziono pliku: {pdf_path}")
+    # Jeden stat: sprawdzenie istnienia i klucz cache (mtime i rozmiar –
+    # zmiana pliku unieważnia wpis)
+    st = _stat_pdf(pdf_path)
+    kind, pairs = _read_xfa_packets_cached(str(pdf_path), st.st_mtime_ns, st.st_size)
+    return _require_packets(kind, dict(pairs))
+
+
+@functools.lru_cache(maxsize=32)
+def _read_xfa_packets_cached(
+    pdf_path: str, mtime_ns: int, size: int
+) -> Tuple["XfaKind", Tuple[Tuple[str, bytes], ...]]:
+    """Odczytaj rodzaj formularza i pakiety z pliku dla danej wersji pliku.
+
+    Zwraca krotkę par, aby wywołujący nie mogli zmienić zapamiętanego wyniku.
+    Rodzaj jest zapamiętywany także dla PDF bez XFA – wywołujący decydują,
+    czy to błąd.
+    """
+    with open_pdf(pdf_path, size=size) as pdf:
+        kind, packets = _xfa_packets(pdf)
+    return kind, tuple(packets.items())
+
+
+read_xfa_packets.cache_clear = _read_xfa_packets_cached.cache_clear  # type: ignore[attr-defined]
+
+
+class XfaKind(Enum):
+    """Rodzaj formularza wg /AcroForm – ustalany bez odczytu strumieni XFA."""
+
+    XFA_ARRAY = "xfa_array"  # /XFA jako tablica [nazwa, strumień, ...]
+    XFA_STREAM = "xfa_stream"  # /XFA jako pojedynczy strumień XDP
+    ACROFORM_ONLY = "acroform_only"  # /AcroForm bez /XFA
+    NONE = "none"  # brak /AcroForm
+
+
+def _xfa_kind(pdf: pikepdf.Pdf) -> Tuple[XfaKind, Any]:
+    """Zwróć (rodzaj, obiekt /XFA lub None) na podstawie samego katalogu dokumentu."""
+    acro_form = _get_pdf_root(pdf).get("/AcroForm", None)
+    if acro_form is None:
+        return XfaKind.NONE, None
+    xfa = acro_form.get("/XFA", None)
+    if xfa is None:
+        return XfaKind.ACROFORM_ONLY, None
+    if isinstance(xfa, pikepdf.Array):
+        return XfaKind.XFA_ARRAY, xfa
+    return XfaKind.XFA_STREAM, xfa
 
-    packets: Dict[str, bytes] = {}
-    with pikepdf.open(str(pdf_path)) as pdf:
-        root = _get_pdf_root(pdf)
-        acro_form = root.get("/AcroForm", None)
-        if acro_form is None:
-            raise ValueError("PDF nie zawiera /AcroForm – brak XFA.")
-
-        xfa = acro_form.get("/XFA", None)
-        if xfa is None:
-            raise ValueError("PDF nie zawiera /XFA – brak pakietów XFA.")
-
-        # Gdy XFA jest tablicą: [name, stream, name, stream, ...]
-        if isinstance(xfa, pikepdf.Array):
-            # iteruj parami: (nazwa, strumień)
-            items = list(xfa)
-            # W niektórych plikach może wystąpić nieparzysta długość – zabezpieczenie.
-            for i in range(0, len(items) - 1, 2):
-                name_obj, stream_obj = items[i], items[i + 1]
-                # Nazwa pakietu jest zwykle typu Name, np. "/template" – usuń wiodące '/'
-                name = str(name_obj).lstrip("/")
-                data = _obj_to_bytes(stream_obj)
-                packets[name] = data
-        else:
-            # Gdy XFA jest pojedynczym strumieniem – brak nazw. Nadaj domyślną.
-            data = _obj_to_bytes(xfa)
-            packets["xfa"] = data
 
+def _read_xfa_packets_from_pdf(pdf: pikepdf.Pdf) -> Dict[str, bytes]:
+    """Odczytaj pakiety XFA z otwartego dokumentu (zob. `read_xfa_packets`)."""
+    return _require_packets(*_xfa_packets(pdf))
+
+
+def _xfa_packets(pdf: pikepdf.Pdf) -> Tuple[XfaKind, Dict[str, bytes]]:
+    """Zwróć (rodzaj, pakiety); dla PDF bez XFA słownik pakietów jest pusty."""
+    kind, xfa = _xfa_kind(pdf)
+    packets: Dict[str, bytes] = {}
+    # Gdy XFA jest tablicą: [name, stream, name, stream, ...]
+    if kind is XfaKind.XFA_ARRAY:
+        # iteruj parami: (nazwa, strumień) – bez kopiowania tablicy do listy.
+        # Przy nieparzystej długości zip pomija ostatni, niesparowany element.
+        it = iter(xfa)
+        for name_obj, stream_obj in zip(it, it):
+            # Nazwa pakietu jest zwykle typu Name, np. "/template" – usuń wiodące '/'
+            name = str(name_obj).lstrip("/")
+            data = _obj_to_bytes(stream_obj)
+            packets[name] = data
+    elif kind is XfaKind.XFA_STREAM:
+        # Gdy XFA jest pojedynczym strumieniem – brak nazw. Nadaj domyślną.
+        data = _obj_to_bytes(xfa)
+        packets["xfa"] = data
+    return kind, packets
+
+
+def _require_packets(kind: XfaKind, packets: Dict[str, bytes]) -> Dict[str, bytes]:
+    """Zwróć pakiety lub zgłoś `ValueError`, gdy dokument nie zawiera XFA."""
+    if kind is XfaKind.NONE:
+        raise ValueError("PDF nie zawiera /AcroForm – brak XFA.")
+    if kind is XfaKind.ACROFORM_ONLY:
+        raise ValueError("PDF nie zawiera /XFA – brak pakietów XFA.")
     if not packets:
         raise ValueError("Nie udało się odczytać żadnych pakietów XFA.")
-
     return packets
 
 
@@ -108,19 +232,33 @@ def choose_packet(
     return name, packets[name]
 
 
-def bytes_to_pretty_xml(xml_bytes: bytes) -> Optional[str]:
+def bytes_to_pretty_xml(xml_bytes: XmlSource) -> Optional[str]:
     """Spróbuj sparsować i sformatować XML do czytelnej postaci.
 
+    Przyjmuje bajty lub już sparsowany korzeń.
     Zwraca tekst XML (unicode) lub None jeśli parser nie powiedzie się.
     """
     try:
-        parser = etree.XMLParser(remove_blank_text=True, recover=True)
-        root = etree.fromstring(xml_bytes, parser)
+        root = _as_root(xml_bytes)
         return etree.tostring(root, pretty_print=True, encoding="unicode")
     except Exception:
         return None
 
 
+def bytes_to_pretty_xml_bytes(xml_bytes: XmlSource) -> Optional[bytes]:
+    """Jak `bytes_to_pretty_xml`, ale zwraca od razu bajty UTF-8 (do zapisu na dysk).
+
+    Pomija pośredni `str` i jego ponowne kodowanie.
+    """
+    try:
+        root = _as_root(xml_bytes)
+        return etree.tostring(
+            root, pretty_print=True, encoding="utf-8", xml_declaration=False
+        )
+    except Exception:
+        return None
+
+
 def save_packet(
     xml_bytes: bytes, output_path: str | Path, pretty: bool = False
 ) -> Path:
@@ -132,9 +270,9 @@ def save_packet(
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
     if pretty:
-        pretty_xml = bytes_to_pretty_xml(xml_bytes)
+        pretty_xml = bytes_to_pretty_xml_bytes(xml_bytes)
         if pretty_xml is not None:
-            output_path.write_text(pretty_xml, encoding="utf-8")
+            output_path.write_bytes(pretty_xml)
             return output_path
 
     # fallback: zapisz surowe bajty (oryginalne kodowanie pozostaje)
@@ -142,8 +280,22 @@ def save_packet(
     return output_path
 
 
+def _decode_xml(xml_bytes: bytes) -> str:
+    """Zdekoduj surowy XML do tekstu w jednym przebiegu.
+
+    Kodowanie wybieramy po BOM (UTF-8 lub UTF-16); bez BOM przyjmujemy UTF-8,
+    a niepoprawne sekwencje zastępujemy znakiem U+FFFD zamiast ponawiać
+    dekodowanie innym kodekiem.
+    """
+    if xml_bytes[:3] == b"\xef\xbb\xbf":
+        return xml_bytes[3:].decode("utf-8", errors="replace")
+    if xml_bytes[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return xml_bytes.decode("utf-16", errors="replace")
+    return xml_bytes.decode("utf-8", errors="replace")
+
+
 def extract_xfa_xml(
-    pdf_path: str | Path,
+    pdf_path: str | Path | pikepdf.Pdf,
     packet: Optional[str] = None,
     pretty: bool = False,
 ) -> Tuple[str, str]:
@@ -155,28 +307,21 @@ def extract_xfa_xml(
     name, xml_bytes = choose_packet(packets, preferred=packet)
     pretty_xml = bytes_to_pretty_xml(xml_bytes) if pretty else None
     if pretty_xml is None:
-        # Spróbuj zdekodować jako utf-8, w razie błędu użyj latin-1 (bezpieczny fallback)
-        try:
-            xml_text = xml_bytes.decode("utf-8")
-        except UnicodeDecodeError:
-            try:
-                xml_text = xml_bytes.decode("utf-16")
-            except UnicodeDecodeError:
-                xml_text = xml_bytes.decode("latin-1")
+        xml_text = _decode_xml(xml_bytes)
     else:
         xml_text = pretty_xml
     return name, xml_text
 
 
-def extract_template_from_xdp_bytes(xml_bytes: bytes) -> Optional[str]:
+def extract_template_from_xdp_bytes(xml_bytes: XmlSource) -> Optional[str]:
     """Wyodrębnij tylko element `<template>` z pełnego XDP/XML.
 
     Ignoruje przestrzenie nazw, szuka dowolnego elementu o nazwie `template`.
+    Przyjmuje bajty lub już sparsowany korzeń.
     Zwraca sformatowany XML (unicode) lub None, jeśli nie znaleziono.
     """
     try:
-        parser = etree.XMLParser(remove_blank_text=True, recover=True)
-        root = etree.fromstring(xml_bytes, parser)
+        root = _as_root(xml_bytes)
         # Wyszukiwanie niezależne od namespace: {namespace}template
         template_el = root.find('.//{*}template')
         if template_el is None:
@@ -186,7 +331,7 @@ def extract_template_from_xdp_bytes(xml_bytes: bytes) -> Optional[str]:
         return None
 
 
-def extract_template_xml(pdf_path: str | Path, pretty: bool = True) -> str:
+def extract_template_xml(pdf_path: str | Path | pikepdf.Pdf, pretty: bool = True) -> str:
     """Zwróć tylko strukturę pól formularza (pakiet `template`).
 
     - Jeśli PDF zawiera osobny pakiet `template`, użyj go.
@@ -200,13 +345,7 @@ def extract_template_xml(pdf_path: str | Path, pretty: bool = True) -> str:
         xml_bytes = packets["template"]
         text = bytes_to_pretty_xml(xml_bytes) if pretty else None
         if text is None:
-            try:
-                text = xml_bytes.decode("utf-8")
-            except UnicodeDecodeError:
-                try:
-                    text = xml_bytes.decode("utf-16")
-                except UnicodeDecodeError:
-                    text = xml_bytes.decode("latin-1")
+            text = _decode_xml(xml_bytes)
         return text
 
     # 2) Brak pakietu – spróbuj odnaleźć `<template>` w XDP
@@ -237,99 +376,231 @@ def _sanitize_ref_name(ref: str) -> Optional[str]:
     # Usuń preambule typu '$.'
     if s.startswith("$."):
         s = s[2:]
-    # Rozbij po kropce lub ukośniku
-    import re
-
-    parts = [p for p in re.split(r"[./]", s) if p]
-    last = parts[-1] if parts else s
+    # Ostatni niepusty segment po kropce lub ukośniku – bez budowania listy segmentów
+    trimmed = s.rstrip("./")
+    if trimmed:
+        last = trimmed[max(trimmed.rfind("."), trimmed.rfind("/")) + 1:]
+    else:
+        last = s
     # Usuń indeksy [n]
-    last = re.sub(r"\[.*?\]", "", last)
+    last = _IDX_RE.sub("", last)
     return last or None
 
 
-def _extract_field_names_from_template_xml(xml_bytes: bytes) -> set[str]:
-    """Zwróć zestaw nazw pól z XFA `<template>`.
+@dataclass(frozen=True)
+class TemplateIndex:
+    """Indeks szablonu XFA zbudowany w jednym przejściu po drzewie.
 
-    Zbiera `field@name`, `exclGroup@name` oraz ostatni segment z `bind/@ref`.
+    - `names` – nazwy pól (`field@name`, `exclGroup@name`, ostatni segment `bind/@ref`),
+    - `bindings` – nazwa pola -> surowy `bind/@ref` (jak `get_bindings_from_template`),
+    - `som_paths` – nazwa pola -> ścieżka SOM (jak `get_som_paths_from_template`).
     """
+
+    names: FrozenSet[str]
+    bindings: Mapping[str, str]
+    som_paths: Mapping[str, str]
+
+    @classmethod
+    def from_bytes(cls, xml_bytes: XmlSource) -> "TemplateIndex":
+        """Zbuduj indeks z bajtów XML lub sparsowanego korzenia (jedno przejście)."""
+        return _build_template_index(xml_bytes)
+
+
+def _build_template_index(xml_bytes: XmlSource) -> TemplateIndex:
     names: set[str] = set()
+    bindings: Dict[str, str] = {}
+    # Grupy wykluczające mogą także posiadać bind; mają pierwszeństwo przed polami
+    # o tej samej nazwie, dlatego zbieramy je osobno i dołączamy na końcu.
+    excl_bindings: Dict[str, str] = {}
+    som_paths: Dict[str, str] = {}
     try:
-        parser = etree.XMLParser(remove_blank_text=True, recover=True)
-        root = etree.fromstring(xml_bytes, parser)
-        for el in root.findall('.//{*}field'):
-            name = el.get('name')
-            if name:
-                names.add(name)
-        for el in root.findall('.//{*}exclGroup'):
+        root = _as_root(xml_bytes)
+        # Stos nazw subformów (ścieżka SOM) oraz otwartych pól/grup:
+        # [słownik docelowy, nazwa, czy znaleziono już pierwszy <bind>]
+        subforms: list[str] = []
+        open_fields: list[list] = []
+        for event, el in etree.iterwalk(root, events=('start', 'end'), tag=_TEMPLATE_TAGS):
+            ln = _local_name(el)
+            if ln == 'subform':
+                n = el.get('name')
+                if n:
+                    if event == 'start':
+                        subforms.append(n)
+                    else:
+                        subforms.pop()
+                continue
+            if el is root:
+                continue
+            if ln == 'bind':
+                if event == 'end':
+                    continue
+                ref = el.get('ref')
+                nm = _sanitize_ref_name(ref) if ref else None
+                if nm:
+                    names.add(nm)
+                # Pierwszy <bind> wewnątrz pola rozstrzyga jego powiązanie (jak
+                # `find('.//bind')`); pola bez niego leżą zawsze na końcu stosu.
+                i = len(open_fields)
+                while i and not open_fields[i - 1][2]:
+                    i -= 1
+                for entry in open_fields[i:]:
+                    entry[2] = True
+                    if ref and entry[1]:
+                        entry[0][entry[1]] = ref
+                continue
+            # field / exclGroup
+            if event == 'end':
+                open_fields.pop()
+                continue
             name = el.get('name')
+            open_fields.append([bindings if ln == 'field' else excl_bindings, name, False])
             if name:
                 names.add(name)
-        for el in root.findall('.//{*}bind[@ref]'):
-            ref = el.get('ref')
-            nm = _sanitize_ref_name(ref) if ref else None
-            if nm:
-                names.add(nm)
+                # Dla pól powtarzalnych zapisz tylko pierwsze wystąpienie
+                if ln == 'field' and name not in som_paths:
+                    som_paths[name] = '.'.join(subforms + [name])
+    except Exception:
+        pass
+    bindings.update(excl_bindings)
+    return TemplateIndex(
+        frozenset(names), MappingProxyType(bindings), MappingProxyType(som_paths)
+    )
+
+
+def _extract_field_names_from_template_xml(xml_bytes: XmlSource) -> set[str]:
+    """Zwróć zestaw nazw pól z XFA `<template>` (bajty lub sparsowany korzeń).
+
+    Zbiera `field@name`, `exclGroup@name` oraz ostatni segment z `bind/@ref`.
+    Duże pakiety (powyżej `STREAM_MIN_BYTES`) są przetwarzane strumieniowo.
+    """
+    if isinstance(xml_bytes, bytes) and len(xml_bytes) > STREAM_MIN_BYTES:
+        return _extract_field_names_streaming(xml_bytes)
+    return set(TemplateIndex.from_bytes(xml_bytes).names)
+
+
+def _extract_field_names_streaming(xml_bytes: bytes) -> set[str]:
+    """Zbierz nazwy pól bez budowy całego drzewa (zob. `_iter_elements_streaming`)."""
+    names: set[str] = set()
+    try:
+        for el in _iter_elements_streaming(xml_bytes):
+            ln = _local_name(el)
+            if ln == 'field' or ln == 'exclGroup':
+                name = el.get('name')
+                if name:
+                    names.add(name)
+            elif ln == 'bind':
+                ref = el.get('ref')
+                nm = _sanitize_ref_name(ref) if ref else None
+                if nm:
+                    names.add(nm)
     except Exception:
         pass
     return names
 
 
-def _extract_acroform_field_names(pdf_path: Path) -> set[str]:
-    """Zwróć nazwy pól z klasycznego AcroForm (`/Fields`)."""
+def _iter_elements_streaming(xml_bytes: bytes) -> Iterator[etree._Element]:
+    """Zwracaj kolejne elementy (bez korzenia) podczas parsowania, zwalniając je na bieżąco.
+
+    Element jest oddawany po zdarzeniu `end` – ma już komplet atrybutów – a potem
+    czyszczony wraz z poprzedzającym rodzeństwem, więc pamięć zależy od głębokości
+    drzewa, nie od rozmiaru dokumentu. Nie zapamiętuj zwróconych elementów.
+    """
+    context = etree.iterparse(
+        io.BytesIO(xml_bytes), events=('end',), huge_tree=True, recover=True
+    )
+    for _, el in context:
+        if el.getparent() is None:
+            # Korzeń kończy dokument; pomijamy go jak `iterdescendants()`
+            break
+        yield el
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+
+def _extract_acroform_field_names_from_pdf(pdf: pikepdf.Pdf) -> set[str]:
+    """Zwróć nazwy pól AcroForm z otwartego dokumentu."""
     names: set[str] = set()
-    with pikepdf.open(str(pdf_path)) as pdf:
-        root = _get_pdf_root(pdf)
-        acro_form = root.get("/AcroForm", None)
-        if acro_form is None:
-            return names
-        fields = acro_form.get("/Fields", pikepdf.Array())
-
-        def is_readonly(field_dict) -> bool:
-            try:
-                ff = field_dict.get("/Ff", 0)
-                ff_int = int(ff) if ff is not None else 0
-                return (ff_int & 1) == 1
-            except Exception:
-                return False
-
-        def walk(field_obj, parent_parts: list[str]):
-            # field_obj powinien być słownikiem
-            name_part = field_obj.get("/T", None)
-            name_part = str(name_part) if name_part is not None else None
-            parts = parent_parts + ([name_part] if name_part else [])
-
-            kids = field_obj.get("/Kids", None)
-            ft = field_obj.get("/FT", None)
-
-            # Dodaj, jeśli to pole (ma typ) i nie jest tylko kontenerem
-            if ft is not None and parts:
-                if not is_readonly(field_obj):
-                    names.add(".".join(parts))
-
-            # Rekurencja w dół jeśli są dzieci
+    root = _get_pdf_root(pdf)
+    acro_form = root.get("/AcroForm", None)
+    if acro_form is None:
+        return names
+    fields = acro_form.get("/Fields", pikepdf.Array())
+    if not isinstance(fields, pikepdf.Array):
+        return names
+
+    # Iteracyjnie (BFS) zamiast rekurencji; części nazwy jako krotki
+    queue: deque = deque((f, ()) for f in fields)
+    while queue:
+        field_obj, parent_parts = queue.popleft()
+        try:
+            name_part, kids, ft, ff = _acro_field_keys(field_obj)
+            parts = parent_parts + (name_part,) if name_part else parent_parts
+
+            # Dodaj, jeśli to pole (ma typ), nie jest tylko kontenerem i nie jest readonly
+            if ft is not None and parts and not _is_readonly(ff):
+                names.add(".".join(parts))
+
             if isinstance(kids, pikepdf.Array):
-                for k in kids:
-                    try:
-                        walk(k, parts)
-                    except Exception:
-                        continue
-
-        if isinstance(fields, pikepdf.Array):
-            for f in fields:
-                try:
-                    walk(f, [])
-                except Exception:
-                    continue
+                queue.extend((k, parts) for k in kids)
+        except Exception:
+            continue
 
     return names
 
 
-def extract_field_keys(pdf_path: str | Path) -> list[str]:
-    """Zwróć listę kluczy pól do wypełnienia (XFA lub AcroForm)."""
-    pdf_path = Path(pdf_path)
+def _acro_field_keys(field_obj) -> Tuple[Optional[str], Any, Any, Any]:
+    """Odczytaj naraz /T (jako str), /Kids, /FT i /Ff słownika pola."""
+    get = field_obj.get
+    name_part = get("/T", None)
+    return (
+        str(name_part) if name_part is not None else None,
+        get("/Kids", None),
+        get("/FT", None),
+        get("/Ff", 0),
+    )
+
+
+def _is_readonly(ff) -> bool:
+    """Sprawdź bit ReadOnly (1) w wartości /Ff."""
+    try:
+        ff_int = int(ff) if ff is not None else 0
+        return (ff_int & 1) == 1
+    except Exception:
+        return False
+
+
+def extract_field_keys(pdf_path: str | Path | pikepdf.Pdf) -> list[str]:
+    """Zwróć listę kluczy pól do wypełnienia (XFA lub AcroForm).
+
+    Dla ścieżki pakiety XFA pochodzą z cache `read_xfa_packets`; dokument
+    jest otwierany tylko na potrzeby fallbacku AcroForm.
+    """
+    if isinstance(pdf_path, pikepdf.Pdf):
+        pdf = pdf_path
+        kind, packets = _xfa_packets(pdf)
+        return _field_keys(kind, packets, lambda: _extract_acroform_field_names_from_pdf(pdf))
+
+    pdf_path, st = _resolve_pdf(pdf_path)
+    kind, pairs = _read_xfa_packets_cached(str(pdf_path), st.st_mtime_ns, st.st_size)
+
+    def acroform_names() -> set[str]:
+        with open_pdf(pdf_path, size=st.st_size) as pdf:
+            return _extract_acroform_field_names_from_pdf(pdf)
+
+    return _field_keys(kind, dict(pairs), acroform_names)
+
+
+def _field_keys(
+    kind: XfaKind, packets: Dict[str, bytes], acroform_names: Callable[[], set[str]]
+) -> list[str]:
+    """Zwróć klucze pól z pakietów XFA; `acroform_names` wołane tylko przy fallbacku."""
+    # Bez XFA od razu AcroForm
+    if kind is XfaKind.ACROFORM_ONLY:
+        return sorted(acroform_names())
 
     # Spróbuj XFA/template
-    packets = read_xfa_packets(pdf_path)
+    packets = _require_packets(kind, packets)
     names: set[str] = set()
 
     if "template" in packets:
@@ -342,85 +613,28 @@ def extract_field_keys(pdf_path: str | Path) -> list[str]:
 
     # Jeżeli z XFA nic nie znaleziono, spróbuj AcroForm
     if not names:
-        names |= _extract_acroform_field_names(pdf_path)
+        names |= acroform_names()
 
     return sorted(names)
 
 
-def get_bindings_from_template(xml_bytes: bytes) -> Dict[str, str]:
+def get_bindings_from_template(xml_bytes: XmlSource) -> Dict[str, str]:
     """Zbuduj mapę: nazwa_pola -> bind/@ref (surowa ścieżka).
 
     Szuka elementów `<field name>` oraz ich potomków `<bind ref>`. Jeśli `bind` nie
     występuje, pole jest pomijane. Nie sanitizujemy ścieżki – zachowujemy oryginał,
     aby lepiej pasował do danych XDP.
     """
-    out: Dict[str, str] = {}
-    try:
-        parser = etree.XMLParser(remove_blank_text=True, recover=True)
-        root = etree.fromstring(xml_bytes, parser)
-        for el in root.findall('.//{*}field'):
-            name = el.get('name')
-            if not name:
-                continue
-            bind = el.find('.//{*}bind')
-            if bind is None:
-                continue
-            ref = bind.get('ref')
-            if ref:
-                out[name] = ref
-        # Grupy wykluczające mogą także posiadać bind
-        for el in root.findall('.//{*}exclGroup'):
-            name = el.get('name')
-            if not name:
-                continue
-            bind = el.find('.//{*}bind')
-            if bind is None:
-                continue
-            ref = bind.get('ref')
-            if ref:
-                out[name] = ref
-    except Exception:
-        pass
-    return out
+    return dict(TemplateIndex.from_bytes(xml_bytes).bindings)
 
 
-def get_som_paths_from_template(xml_bytes: bytes) -> Dict[str, str]:
+def get_som_paths_from_template(xml_bytes: XmlSource) -> Dict[str, str]:
     """Zbuduj mapę: nazwa_pola -> pełna ścieżka SOM (np. form1.SUB1.SUB102.Nazwisko).
 
     Ścieżka SOM powstaje z nazw kolejnych `<subform name>` zakończona `field@name`.
     Dla pól powtarzalnych zwracamy pierwsze znalezione wystąpienie.
     """
-    result: Dict[str, str] = {}
-    try:
-        parser = etree.XMLParser(remove_blank_text=True, recover=True)
-        root = etree.fromstring(xml_bytes, parser)
-
-        def local_name(el: etree._Element) -> str:
-            tag = el.tag
-            if isinstance(tag, str) and tag.startswith('{'):
-                return tag.split('}', 1)[1]
-            return tag if isinstance(tag, str) else ''
-
-        for field in root.findall('.//{*}field[@name]'):
-            field_name = field.get('name')
-            if not field_name:
-                continue
-            # Zbierz nazwy subformów w górę drzewa
-            names = [field_name]
-            p = field.getparent()
-            while p is not None:
-                ln = local_name(p)
-                if ln == 'subform':
-                    n = p.get('name')
-                    if n:
-                        names.append(n)
-                p = p.getparent()
-            som_path = '.'.join(reversed(names))
-            # Zapisz tylko pierwsze wystąpienie
-            result.setdefault(field_name, som_path)
-    except Exception:
-        pass
-    return result
+    return dict(TemplateIndex.from_bytes(xml_bytes).som_paths)
 
 
 def _derive_output_path(
@@ -471,15 +685,17 @@ def main() -> None:
     args = parser.parse_args()
 
     pdf_path = Path(args.pdf)
-    packet_name, xml_text = extract_xfa_xml(pdf_path, packet=args.packet, pretty=args.pretty)
 
     if args.do_print:
+        _, xml_text = extract_xfa_xml(pdf_path, packet=args.packet, pretty=args.pretty)
         print(xml_text)
         return
 
+    # Zapis do pliku bez pośredniego `str` – bajty pakietu (lub sformatowane bajty UTF-8)
+    packet_name, xml_bytes = choose_packet(read_xfa_packets(pdf_path), preferred=args.packet)
     out_dir = Path(args.out_dir)
     output_path = _derive_output_path(pdf_path, out_dir, packet_name)
-    save_packet(xml_text.encode("utf-8"), output_path, pretty=False)
+    save_packet(xml_bytes, output_path, pretty=args.pretty)
     print(f"Zapisano XML pakietu '{packet_name}' do: {output_path}")
 
 
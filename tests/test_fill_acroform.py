@@ -0,0 +1,50 @@
+import unittest
+
+from fill_acroform import build_resolvers
+
+
+def _entry(name: str, base: str) -> dict:
+    return {"name": name, "base": base, "field": None, "widgets": [], "ft": None, "ff": 0}
+
+
+def _resolve(resolvers, key: str):
+    # ta sama kolejność co w `fill_acroform_with_json`
+    exact, lowered = resolvers
+    return exact.get(key) or lowered.get(key.lower())
+
+
+class BuildResolversTest(unittest.TestCase):
+    def test_exact_short_name_beats_case_insensitive_full_name(self):
+        short = _entry("form1.Nazwisko", "Nazwisko")
+        full = _entry("NAZWISKO", "NAZWISKO")
+        resolvers = build_resolvers(
+            {short["name"]: short, full["name"]: full},
+            {"Nazwisko": [short], "NAZWISKO": [full]},
+        )
+        self.assertIs(_resolve(resolvers, "Nazwisko"), short)
+        self.assertIs(_resolve(resolvers, "nazwisko"), full)
+
+    def test_full_name_beats_short_name(self):
+        full = _entry("Imie", "Imie")
+        short = _entry("form1.Imie", "Imie")
+        resolvers = build_resolvers(
+            {full["name"]: full, short["name"]: short},
+            {"Imie": [full, short]},
+        )
+        self.assertIs(_resolve(resolvers, "Imie"), full)
+        self.assertIs(_resolve(resolvers, "imie"), full)
+
+    def test_ambiguous_short_names_are_skipped(self):
+        first = _entry("a.Imie", "Imie")
+        second = _entry("b.Imie", "Imie")
+        resolvers = build_resolvers(
+            {first["name"]: first, second["name"]: second},
+            {"Imie": [first, second]},
+        )
+        self.assertIsNone(_resolve(resolvers, "Imie"))
+        self.assertIsNone(_resolve(resolvers, "imie"))
+        self.assertIs(_resolve(resolvers, "b.imie"), second)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import pikepdf
+
+from extract_acroform import extract_acroform
+from fill_acroform import fill_acroform_with_json
+from src.pdf_session import PdfSession
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _values_by_name(pdf_path: Path) -> dict:
+    values = {}
+    with pikepdf.open(str(pdf_path)) as pdf:
+        stack = list(pdf.Root.AcroForm.get("/Fields", []))
+        while stack:
+            field = stack.pop()
+            if "/T" in field:
+                values.setdefault(str(field.T), field.get("/V"))
+            stack.extend(field.get("/Kids", []))
+    return values
+
+
+class ExtractThenFillTest(unittest.TestCase):
+    def test_extract_then_fill_on_one_session(self):
+        # Ekstrakcja i wypełnianie dzielą `field_cache` – wypełnienie musi nadal ustawić /V
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp_path = Path(tmp)
+            json_in = tmp_path / "dane.json"
+            json_in.write_text(json.dumps({"Nazwisko": "Regresja-Sesji"}), encoding="utf-8")
+            pdf_out = tmp_path / "out.pdf"
+
+            with PdfSession(ROOT / "wypelniony_acro.pdf") as session:
+                extract_acroform(session, tmp_path / "schemat.xml", tmp_path / "pola.txt")
+                fill_acroform_with_json(session, json_in, pdf_out)
+
+            self.assertEqual(str(_values_by_name(pdf_out)["Nazwisko"]), "Regresja-Sesji")
+
+
+if __name__ == "__main__":
+    unittest.main()
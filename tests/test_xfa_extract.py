@@ -0,0 +1,72 @@
+import unittest
+
+from src.xfa_extract import TemplateIndex
+
+TEMPLATE = b"""<template xmlns="http://www.xfa.org/schema/xfa-template/3.3/">
+  <subform name="form1">
+    <subform>
+      <subform name="Str1">
+        <field name="Nazwisko"><bind match="dataRef" ref="$.Dane.Nazwisko[0]"/></field>
+      </subform>
+      <field name="Nazwisko"><bind ref="$.Inne.Nazwisko"/></field>
+    </subform>
+    <field name="BezRef"><bind match="none"/><bind ref="$.Drugi"/></field>
+    <exclGroup name="Plec">
+      <field name="K"><bind ref="$.Plec.K"/></field>
+      <bind ref="$.Plec"/>
+    </exclGroup>
+    <field name="Plec"><bind ref="$.PoleOPlec"/></field>
+  </subform>
+</template>"""
+
+
+class TemplateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = TemplateIndex.from_bytes(TEMPLATE)
+
+    def test_excl_group_takes_first_bind_inside_child_field(self):
+        # Pierwszy <bind> w kolejności dokumentu leży w polu potomnym grupy
+        self.assertEqual(self.index.bindings["K"], "$.Plec.K")
+        # ...a wiązanie grupy nadpisuje pole o tej samej nazwie
+        self.assertEqual(self.index.bindings["Plec"], "$.Plec.K")
+
+    def test_first_bind_without_ref_means_no_binding(self):
+        self.assertNotIn("BezRef", self.index.bindings)
+        # kolejny <bind> nadal dostarcza nazwę
+        self.assertIn("Drugi", self.index.names)
+
+    def test_repeated_field_names(self):
+        # wiązanie: ostatnie wystąpienie; ścieżka SOM: pierwsze
+        self.assertEqual(self.index.bindings["Nazwisko"], "$.Inne.Nazwisko")
+        self.assertEqual(self.index.som_paths["Nazwisko"], "form1.Str1.Nazwisko")
+
+    def test_som_paths_skip_unnamed_subforms(self):
+        self.assertEqual(
+            dict(self.index.som_paths),
+            {
+                "Nazwisko": "form1.Str1.Nazwisko",
+                "BezRef": "form1.BezRef",
+                "K": "form1.K",
+                "Plec": "form1.Plec",
+            },
+        )
+
+    def test_names(self):
+        self.assertEqual(
+            self.index.names,
+            {"BezRef", "Drugi", "K", "Nazwisko", "Plec", "PoleOPlec"},
+        )
+
+    def test_root_subform_is_part_of_path(self):
+        index = TemplateIndex.from_bytes(b'<subform name="form1"><field name="A"/></subform>')
+        self.assertEqual(dict(index.som_paths), {"A": "form1.A"})
+
+    def test_root_field_is_not_indexed(self):
+        index = TemplateIndex.from_bytes(b'<field name="Korzen"><bind ref="$.X"/></field>')
+        self.assertEqual(dict(index.bindings), {})
+        self.assertEqual(dict(index.som_paths), {})
+        self.assertEqual(index.names, {"X"})
+
+
+if __name__ == "__main__":
+    unittest.main()